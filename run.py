@@ -104,6 +104,13 @@ def tqdb():
     )
     argparser.add_argument("-f", "--force", action="store", default=False, dest="force_parsing")
     argparser.add_argument("-a", "--all-languages", action="store_true", default=False, dest="all_languages")
+    argparser.add_argument(
+        "--optimize-png",
+        help="Recompress the sprite image with optipng, if it is installed",
+        action="store_true",
+        default=False,
+        dest="optimize_png",
+    )
 
     argparser.add_argument(
         "-d",
@@ -121,12 +128,14 @@ def tqdb():
 
     def create_sprite_sheet():
         start_time = time.time()
-        images.SpriteCreator()
+        sprite = images.SpriteCreator.build(optimize_png=args.optimize_png)
+        if sprite:
+            sprite.save()
         logging.info(f"Sprite sheet took {time.time() - start_time:.2f}s")
 
-    # Ensure required directories exist:
-    if not os.path.exists(paths.GRAPHICS):
-        os.makedirs(paths.GRAPHICS)
+    # Ensure the output directory exists, graphics are created when bitmaps are saved:
+    if not os.path.exists(paths.OUTPUT):
+        os.makedirs(paths.OUTPUT)
 
     # Only parse the database into its intermediate form if forced or not yet done
     # if args.force_parsing or not os.path.exists(paths.CACHE):
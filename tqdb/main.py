@@ -189,6 +189,9 @@ def parse_equipment():
         if category:
             items[category].append(parsed)
 
+    # Convert all the bitmaps that were saved while parsing:
+    images.flush_bitmaps()
+
     # Log the timer:
     logging.info(f"Parsed equipment in {time.time() - start_time:.2f} seconds.")
 
@@ -5,14 +5,114 @@ Classes and functionality to store TQ images and styling.
 import logging
 import os
 import subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from shutil import rmtree
+from shutil import rmtree, which
 
+import numpy as np
 from PIL import Image
 
 from tqdb.constants import paths
 
 
+def _px(n):
+    """
+    Format a CSS length in pixels, leaving out the unit for zero.
+
+    """
+    return f"{n}px" if n else "0"
+
+
+class Skyline:
+    """
+    Skyline bin packer.
+
+    Keeps track of the top edge of everything packed so far as a list of
+    (x, y, width) segments that span the full width of the bin. Each new
+    rectangle is placed at the lowest point of the skyline it fits in.
+
+    """
+
+    def __init__(self, width):
+        self.width = width
+        self.segments = [(0, 0, width)]
+        self.max_y = 0
+
+    def pack(self, width, height):
+        """
+        Pack a rectangle and return the (x, y) position it was placed at.
+
+        """
+        if width > self.width:
+            raise ValueError(f"Cannot pack a {width}px wide rectangle into a {self.width}px wide skyline")
+
+        best_index = best_y = None
+        for index, (x, _, _) in enumerate(self.segments):
+            # Segments are ordered by x, so none of the next ones will fit either
+            if x + width > self.width:
+                break
+
+            y = self._fit(index, width)
+            if best_y is None or y < best_y:
+                best_index, best_y = index, y
+
+        x = self.segments[best_index][0]
+        self._place(best_index, x, best_y + height, width)
+        self.max_y = max(self.max_y, best_y + height)
+
+        return x, best_y
+
+    def _fit(self, index, width):
+        """
+        Find the lowest y a rectangle fits at when starting at a segment.
+
+        """
+        y = 0
+        remaining = width
+        while remaining > 0:
+            _, segment_y, segment_width = self.segments[index]
+            y = max(y, segment_y)
+            remaining -= segment_width
+            index += 1
+
+        return y
+
+    def _place(self, index, x, y, width):
+        """
+        Raise the skyline from x to x + width up to y.
+
+        """
+        right = x + width
+        segments = self.segments[:index]
+        segments.append((x, y, width))
+
+        # Drop (or cut off) the segments that are now covered:
+        for segment_x, segment_y, segment_width in self.segments[index:]:
+            segment_right = segment_x + segment_width
+            if segment_right <= right:
+                continue
+            elif segment_x < right:
+                segments.append((right, segment_y, segment_right - right))
+            else:
+                segments.append((segment_x, segment_y, segment_width))
+
+        # Merge neighbouring segments that ended up at the same height:
+        self.segments = [segments[0]]
+        for segment in segments[1:]:
+            last_x, last_y, last_width = self.segments[-1]
+            if last_y == segment[1]:
+                self.segments[-1] = (last_x, last_y, last_width + segment[2])
+            else:
+                self.segments.append(segment)
+
+
+# Position and (cropped) size of an image packed into the sprite, padding holds the
+# transparent (top, right, bottom, left) borders that were cropped off the image
+PlacedRect = namedtuple("PlacedRect", ["name", "file", "x", "y", "width", "height", "padding"])
+
+
 class SpriteCreator:
     """
     SpriteCreator class.
@@ -20,145 +120,197 @@ class SpriteCreator:
     Class that takes the bitmap outputs from the TQDB Parser and creates a
     single sprite image and the corresponding sprite stylesheet.
 
-    """
+    Use SpriteCreator.build to scan and pack the images, which only holds on
+    to the packed layout. The images are decoded when rendering or saving.
+    Pass optimize_png to recompress the saved sprite with optipng.
 
-    def __init__(self):
-        # Image map will be used to categorize by sizes
-        images_map = {}
-        images = []
-
-        try:
-            # Iterate through all the files and make a list of the image objects
-            for file in paths.GRAPHICS.glob('*.png'):
-                image = Image.open(file)
-                image.filename = os.path.basename(file).split(".")[0]
-                images.append(image)
-
-            if len(images) <= 0:
-                logging.warning(f"No images found in {paths.GRAPHICS}. Skipping creation of sprite sheet.")
-                return
-
-            logging.info(f"Combining {len(images)} images into a sprite sheet.")
-
-            # Sort images so output is consistent (useful for diffs)
-            images.sort(key=lambda x: x.filename)
-
-            # Iterate through all the image objects and organize them by size
-            for image in images:
-                width, height = image.size
-
-                # Append this image to its size list, or create a new size list
-                key = f"{width}x{height}"
-                if key in images_map:
-                    images_map[key].append(image)
-                else:
-                    images_map[key] = [image]
-
-            # Keep a sorted list of the keys (descending by height):
-            sorted_keys = list(images_map.keys())
-            sorted_keys.sort(key=lambda x: int(x.split("x")[1]))
-
-            # Maximum width of the sprite is 768px
-            sprite_width = 768
-            sprite_height = 0
-            sprite_css = ".{0} {{\n" "  background-position: {1} {2};\n" "  width: {3};\n" "  height: {4};\n}}\n"
-
-            # Keep track of the canvases (per size) and css (per image)
-            css = []
-            canvases = []
-
-            # Run through the keys (sorted by descending height)
-            for key in sorted_keys:
-                canvas_width, canvas_height = tuple(map(int, key.split("x")))
-
-                canvas = Image.new(mode="RGBA", size=(sprite_width, canvas_height), color=(0, 0, 0, 0))
-                x = 0
-
-                # Iterate over all the images in this size:
-                for index, image in enumerate(images_map[key]):
-                    image_width, image_height = image.size
-                    if x + image_width < sprite_width:
-                        canvas.paste(image, (x, 0))
-                        css.append(
-                            sprite_css.format(
-                                image.filename,
-                                f"{0 - x}px" if 0 - x != 0 else 0 - x,
-                                (f"{0 - sprite_height}px" if 0 - sprite_height != 0 else 0 - sprite_height),
-                                (f"{image_width}px" if image_width != 0 else image_width),
-                                (f"{image_height}px" if image_height != 0 else image_height),
-                            )
-                        )
-                        x += image_width
-
-                    elif x + image_width == sprite_width:
-                        canvas.paste(image, (x, 0))
-                        css.append(
-                            sprite_css.format(
-                                image.filename,
-                                f"{0 - x}px" if 0 - x != 0 else 0 - x,
-                                (f"{0 - sprite_height}px" if 0 - sprite_height != 0 else 0 - sprite_height),
-                                (f"{image_width}px" if image_width != 0 else image_width),
-                                (f"{image_height}px" if image_height != 0 else image_height),
-                            )
-                        )
-
-                        if index == len(images_map[key]) - 1:
-                            # Last image, append canvas:
-                            canvases.append(canvas)
-                            sprite_height += canvas_height
-                        else:
-                            # More images to come, reset row:
-                            x += image_width
-                    else:
-                        canvases.append(canvas)
-                        canvas = Image.new(mode="RGBA", size=(sprite_width, canvas_height), color=(0, 0, 0, 0))
-                        canvas.paste(image, (0, 0))
-                        x = image_width
-                        sprite_height += canvas_height
-
-                        css.append(
-                            sprite_css.format(
-                                image.filename,
-                                0,
-                                (f"{0 - sprite_height}px" if 0 - sprite_height != 0 else 0 - sprite_height),
-                                (f"{image_width}px" if image_width != 0 else image_width),
-                                (f"{image_height}px" if image_height != 0 else image_height),
-                            )
-                        )
-
-                # Append last row
-                if x < sprite_width:
-                    canvases.append(canvas)
-                    sprite_height += canvas_height
-        finally:
-            for image in images:
-                image.close()
-
-        # Create the new sprite image
-        sprite_image = Image.new(mode="RGBA", size=(sprite_width, sprite_height), color=(0, 0, 0, 0))
-        sprite_y = 0
-
-        # Paste all the canvases on the sprite image
-        for canvas in canvases:
-            sprite_image.paste(canvas, (0, sprite_y))
-            sprite_y += canvas.size[1]
-
-        # Save the sprite
-        sprite_image.save(paths.OUTPUT / "sprite.png", optimize=True)
-
-        # Save the CSS
-        css.sort()
-        with open(paths.OUTPUT / "sprite.css", "w") as css_file:
-            for line in css:
-                css_file.write(f"{line}\n")
+    """
 
+    # Maximum width of the sprite is 768px
+    sprite_width = 768
+    sprite_css = ".{0} {{\n" "  background-position: {1} {2};\n" "  width: {3};\n" "  height: {4};\n{5}}}\n\n"
+    padding_css = (
+        "  box-sizing: content-box;\n"
+        "  padding: {0};\n"
+        "  background-origin: content-box;\n"
+        "  background-clip: content-box;\n"
+    )
+
+    def __init__(self, rects, sprite_dir=paths.GRAPHICS, output_dir=paths.OUTPUT, optimize_png=False):
+        self.rects = rects
+        self.sprite_dir = sprite_dir
+        self.output_dir = output_dir
+        self.optimize_png = optimize_png
+
+    @classmethod
+    def build(cls, sprite_dir=paths.GRAPHICS, output_dir=paths.OUTPUT, optimize_png=False):
+        """
+        Scan and pack the images in a directory.
+
+        Returns None if there are no images to combine.
+
+        """
+        entries = cls._scan(sprite_dir)
+        if len(entries) <= 0:
+            logging.warning(f"No images found in {sprite_dir}. Skipping creation of sprite sheet.")
+            return None
+
+        logging.info(f"Combining {len(entries)} images into a sprite sheet.")
+        return cls(cls._pack(entries), sprite_dir, output_dir, optimize_png)
+
+    @property
+    def height(self):
+        """
+        Height of the sprite, the lowest edge of all packed images.
+
+        """
+        return max(rect.y + rect.height for rect in self.rects)
+
+    def render(self):
+        """
+        Composite all the images into an RGBA buffer.
+
+        """
+        sprite = np.zeros((self.height, self.sprite_width, 4), dtype=np.uint8)
+        self._composite(self.rects, sprite)
+        return sprite
+
+    def save(self):
+        """
+        Save the sprite image and stylesheet and remove the separate images.
+
+        """
+        self._save_png(self.render())
+        self._save_css()
+        self._cleanup()
+
+    @staticmethod
+    def _scan(sprite_dir):
+        if not sprite_dir.is_dir():
+            return []
+
+        with os.scandir(sprite_dir) as it:
+            return [entry for entry in it if entry.name.endswith(".png")]
+
+    @classmethod
+    def _pack(cls, entries):
+        # Read the name, path, cropped size and padding of all the images.
+        # This decodes every image to find its transparent borders.
+        # Sort them so output is consistent (useful for diffs)
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            names, files, widths, heights, paddings = zip(*sorted(executor.map(read_image_spec, entries)))
+        widths = np.array(widths, dtype=np.int32)
+        heights = np.array(heights, dtype=np.int32)
+
+        # Pack the tallest images first, lexsort is stable so equally sized images stay in name order
+        skyline = Skyline(cls.sprite_width)
+        xs = np.zeros(len(names), dtype=np.int32)
+        ys = np.zeros(len(names), dtype=np.int32)
+        for index in np.lexsort((-widths, -heights)):
+            xs[index], ys[index] = skyline.pack(int(widths[index]), int(heights[index]))
+
+        return list(
+            map(PlacedRect, names, files, xs.tolist(), ys.tolist(), widths.tolist(), heights.tolist(), paddings)
+        )
+
+    @staticmethod
+    def _composite(rects, sprite):
+        # Decode all the images in parallel straight into the buffer
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            list(executor.map(partial(paste_image, sprite), rects))
+
+    def _save_png(self, sprite):
+        # Save the sprite, as an 8-bit palette image if that is lossless
+        sprite_image = to_palette_image(sprite) or Image.fromarray(sprite)
+        sprite_image.save(self.output_dir / "sprite.png", compress_level=6)
+
+        if not self.optimize_png:
+            return
+
+        if not which("optipng"):
+            logging.warning("optipng not found. Skipping optimization of the sprite image.")
+            return
+
+        subprocess.run(["optipng", "-quiet", "-o2", str(self.output_dir / "sprite.png")])
+
+    def _save_css(self):
+        # Rules are written in name order. Cropped images get their transparent borders back as padding,
+        # with the box model pinned and the background kept to the content box, so the element keeps its
+        # original box.
+        css = []
+        for rect in self.rects:
+            padding = self.padding_css.format(" ".join(map(_px, rect.padding))) if any(rect.padding) else ""
+            position = _px(-rect.x), _px(-rect.y)
+            css.append(self.sprite_css.format(rect.name, *position, _px(rect.width), _px(rect.height), padding))
+        with open(self.output_dir / "sprite.css", "w", buffering=1 << 20) as css_file:
+            css_file.writelines(css)
+
+    def _cleanup(self):
         # Remove all the images
-        rmtree(paths.GRAPHICS)
+        rmtree(self.sprite_dir)
+        _existing_graphics.pop(self.sprite_dir, None)
+
+
+def read_image_spec(entry):
+    """
+    Read the name, path, cropped size and padding of an image.
+
+    The image is cropped to its non-transparent pixels, the padding holds the
+    (top, right, bottom, left) borders that were cropped off. Fully
+    transparent images are not cropped. Finding the borders means the image
+    is decoded here, and again when it is copied into the sprite.
+
+    """
+    with Image.open(entry.path) as image:
+        width, height = image.size
+        left, top, right, bottom = image.convert("RGBA").getchannel("A").getbbox() or (0, 0, width, height)
+
+    return entry.name[:-4], entry.path, right - left, bottom - top, (top, width - right, height - bottom, left)
+
+
+def paste_image(sprite, rect):
+    """
+    Decode an image and copy it into the sprite buffer at its packed position.
+
+    Pillow releases the GIL while decoding, so this can run in a worker
+    thread. Each image is only kept open while it is being copied.
+
+    """
+    top, _, _, left = rect.padding
+    with Image.open(rect.file) as image:
+        image = image.convert("RGBA").crop((left, top, left + rect.width, top + rect.height))
+        sprite[rect.y : rect.y + rect.height, rect.x : rect.x + rect.width] = np.asarray(image)
+
+
+def to_palette_image(sprite):
+    """
+    Convert an RGBA buffer into an 8-bit palette image.
+
+    Returns None if the buffer has more than 256 colors, since quantizing
+    those would be lossy.
+
+    """
+    height, width, _ = sprite.shape
+    if Image.fromarray(sprite).getcolors(256) is None:
+        return None
+
+    # View every pixel as a single 32-bit value to index the unique colors
+    colors, indices = np.unique(sprite.view(np.uint32), return_inverse=True)
+    image = Image.frombytes("P", (width, height), indices.astype(np.uint8).tobytes())
+    image.putpalette(colors.view(np.uint8).tobytes(), rawmode="RGBA")
+    return image
 
 
 ###############################################################################
 #                              BITMAP UTILITY                                 #
 ###############################################################################
+# Pending TextureViewer conversions, mapping the output PNG to its TEX file
+_bitmaps = {}
+
+# File names in each graphics directory, listed on first use and updated with every converted bitmap
+_existing_graphics = {}
+
+
 def save_bitmap(item, item_type: str, graphics: Path):
     bitmap = item.pop("bitmap", None)
     tag = item["tag"]
@@ -167,39 +319,90 @@ def save_bitmap(item, item_type: str, graphics: Path):
         logging.warning(f'Missing tag or bitmap for {item["tag"]}: {bitmap}')
         return
 
+    # Create and list the graphics directory the first time it is used
+    if graphics not in _existing_graphics:
+        graphics.mkdir(parents=True, exist_ok=True)
+        _existing_graphics[graphics] = set(os.listdir(graphics))
+    existing = _existing_graphics[graphics]
+
     # Tags for formula's are all the same (lesser, greater, divine)
     if item_type == "ItemArtifactFormula":
         tag = item["classification"].lower()
-    # Skip all non-MI duplicates
-    elif item.get("classification", None) != "Rare" and os.path.isfile(graphics / f"{tag}.png"):
+    # Skip all non-MI duplicates, whether they are converted or still queued
+    elif item.get("classification", None) != "Rare" and (
+        f"{tag}.png" in existing or graphics / f"{tag}.png" in _bitmaps
+    ):
+        return
+
+    # Skip bitmaps that haven't changed since they were last converted
+    output = graphics / f"{tag}.png"
+    if (
+        output.name in existing
+        and output not in _bitmaps
+        and output.is_file()
+        and output.stat().st_mtime >= bitmap.stat().st_mtime
+    ):
         return
 
     filename = str(bitmap)
-    h = open(bitmap, "rb")
-    alls = h.read()
-    h.close()
-    magic = b"TEX" + b"\x02"
-    magicpos = alls.find(magic)
-
-    if magicpos == 0:
-        ba = bytearray(alls)
-        ba[3] = 1
-        ba.pop(8)
-        alls2 = bytes(ba)
-        basename, file_extension = os.path.splitext(bitmap)
-        filename = basename + ".fixed" + file_extension
-        h2 = open(filename, "wb")
-        h2.write(alls2)
-        h2.close()
-
-    # Run the texture viewer if a bitmap and tag are set:
+    with open(bitmap, "rb") as h:
+        magic = h.read(4)
+
+        # TextureViewer only reads version 1 TEX files, convert version 2 ones by dropping their extra header byte.
+        # The converted file is kept next to the original and only rewritten when the original changes.
+        if magic == b"TEX" + b"\x02":
+            basename, file_extension = os.path.splitext(bitmap)
+            filename = basename + ".fixed" + file_extension
+            if not os.path.isfile(filename) or os.path.getmtime(filename) < bitmap.stat().st_mtime:
+                ba = bytearray(magic + h.read())
+                ba[3] = 1
+                ba.pop(8)
+                with open(filename, "wb") as h2:
+                    h2.write(ba)
+
+    # Queue the texture viewer conversion, output file name being the tag:
+    _bitmaps[output] = filename
+
+    return
+
+
+def flush_bitmaps():
+    """
+    Convert all the bitmaps queued by save_bitmap.
+
+    TextureViewer only converts a single file per run, so the runs are
+    spread over a pool of workers to overlap the process startup cost.
+
+    """
+    if not _bitmaps:
+        return
+
+    logging.info(f"Converting {len(_bitmaps)} bitmaps.")
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        # Consume the results so any exceptions are raised here
+        list(executor.map(convert_bitmap, _bitmaps.values(), _bitmaps.keys()))
+
+    # Only list the conversions that produced their PNG, so failed ones are tried again
+    for output, filename in _bitmaps.items():
+        if output.is_file():
+            _existing_graphics.setdefault(output.parent, set()).add(output.name)
+        else:
+            logging.warning(f"Failed to convert bitmap {filename} to {output}")
+
+    _bitmaps.clear()
+
+
+def convert_bitmap(filename, output):
+    """
+    Run the texture viewer to convert a TEX file into a PNG.
+
+    """
     command = [
         "utils/textureviewer/TextureViewer.exe",
         # Convert path to string
         str(filename),
-        # Output to graphics folder, file name being the tag.
-        str(graphics / f"{tag}.png"),
+        # Output to graphics folder
+        str(output),
     ]
-    subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-    return
+    subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
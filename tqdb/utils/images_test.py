@@ -0,0 +1,200 @@
+"""
+Tests for the sprite sheet packing.
+
+"""
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from tqdb.utils import images
+from tqdb.utils.images import Skyline, SpriteCreator, to_palette_image
+
+
+def test_skyline_fills_row():
+    skyline = Skyline(100)
+
+    assert skyline.pack(40, 20) == (0, 0)
+    assert skyline.pack(40, 20) == (40, 0)
+    assert skyline.pack(20, 10) == (80, 0)
+    assert skyline.max_y == 20
+
+
+def test_skyline_stacks_when_row_is_full():
+    skyline = Skyline(100)
+
+    skyline.pack(60, 30)
+    skyline.pack(40, 20)
+
+    # The lowest spot for a rect this wide is on top of the second rect
+    assert skyline.pack(40, 10) == (60, 20)
+    # The next one doesn't fit next to anything anymore
+    assert skyline.pack(100, 10) == (0, 30)
+    assert skyline.max_y == 40
+
+
+def test_skyline_fills_gaps_below_higher_segments():
+    skyline = Skyline(100)
+
+    skyline.pack(50, 40)
+    skyline.pack(50, 10)
+
+    assert skyline.pack(50, 10) == (50, 10)
+    assert skyline.segments == [(0, 40, 50), (50, 20, 50)]
+
+
+def test_skyline_rejects_rect_wider_than_bin():
+    skyline = Skyline(100)
+
+    with pytest.raises(ValueError):
+        skyline.pack(101, 10)
+
+
+def test_palette_image_is_lossless():
+    colors = np.arange(256 * 4, dtype=np.uint8).reshape(256, 4)
+    sprite = colors[np.arange(32 * 16).reshape(32, 16) % 256]
+
+    image = to_palette_image(sprite)
+
+    assert image.mode == "P"
+    assert (np.asarray(image.convert("RGBA")) == sprite).all()
+
+
+def test_palette_image_skips_too_many_colors():
+    # 512 unique colors
+    sprite = np.zeros((32, 16, 4), dtype=np.uint8)
+    sprite[..., 0] = np.arange(32 * 16).reshape(32, 16) % 256
+    sprite[..., 1] = np.arange(32 * 16).reshape(32, 16) // 256
+
+    assert to_palette_image(sprite) is None
+
+
+def test_sprite_creator_packs_images_in_name_order(tmp_path):
+    Image.new("RGBA", (32, 32), (255, 0, 0, 255)).save(tmp_path / "b.png")
+    Image.new("RGBA", (32, 64), (0, 255, 0, 255)).save(tmp_path / "a.png")
+
+    sprite = SpriteCreator.build(tmp_path, tmp_path)
+
+    assert [(rect.name, rect.x, rect.y, rect.width, rect.height) for rect in sprite.rects] == [
+        ("a", 0, 0, 32, 64),
+        ("b", 32, 0, 32, 32),
+    ]
+    assert sprite.render()[0, 32].tolist() == [255, 0, 0, 255]
+
+
+def test_sprite_creator_crops_transparent_borders(tmp_path):
+    image = Image.new("RGBA", (32, 32), (0, 0, 0, 0))
+    image.paste((0, 0, 255, 255), (2, 4, 22, 14))
+    image.save(tmp_path / "a.png")
+
+    sprite = SpriteCreator.build(tmp_path, tmp_path)
+
+    rect = sprite.rects[0]
+    assert (rect.x, rect.y, rect.width, rect.height, rect.padding) == (0, 0, 20, 10, (4, 10, 18, 2))
+    assert sprite.render().shape == (10, SpriteCreator.sprite_width, 4)
+    assert sprite.render()[9, 19].tolist() == [0, 0, 255, 255]
+
+    sprite._save_css()
+    assert (tmp_path / "sprite.css").read_text() == (
+        ".a {\n"
+        "  background-position: 0 0;\n"
+        "  width: 20px;\n"
+        "  height: 10px;\n"
+        "  box-sizing: content-box;\n"
+        "  padding: 4px 10px 18px 2px;\n"
+        "  background-origin: content-box;\n"
+        "  background-clip: content-box;\n"
+        "}\n\n"
+    )
+
+
+def test_sprite_creator_skips_missing_directory(tmp_path):
+    assert SpriteCreator.build(tmp_path / "missing", tmp_path) is None
+
+
+@pytest.fixture
+def conversions(monkeypatch):
+    """
+    Reset the bitmap queue and record the conversions instead of running TextureViewer.
+
+    Conversions write a PNG with the name of the TEX file they were converted
+    from, unless the TEX file name contains 'broken'.
+
+    """
+    converted = []
+
+    def convert_bitmap(filename, output):
+        converted.append((os.path.basename(filename), output.name))
+        if "broken" not in filename:
+            output.write_text(os.path.basename(filename))
+
+    monkeypatch.setattr(images, "_bitmaps", {})
+    monkeypatch.setattr(images, "_existing_graphics", {})
+    monkeypatch.setattr(images, "convert_bitmap", convert_bitmap)
+    return converted
+
+
+def save_bitmap(tmp_path, bitmap, tag, classification="Common"):
+    item = {"bitmap": tmp_path / bitmap, "tag": tag, "classification": classification}
+    if not item["bitmap"].exists():
+        item["bitmap"].write_bytes(b"TEX\x01")
+
+    images.save_bitmap(item, "ItemEquipment", tmp_path / "graphics")
+
+
+def test_save_bitmap_retries_failed_mi_conversion(tmp_path, conversions):
+    save_bitmap(tmp_path, "broken.tex", "tag", "Rare")
+    images.flush_bitmaps()
+    save_bitmap(tmp_path, "broken.tex", "tag", "Rare")
+    images.flush_bitmaps()
+
+    assert conversions == [("broken.tex", "tag.png"), ("broken.tex", "tag.png")]
+
+
+def test_save_bitmap_skips_duplicate_tags(tmp_path, conversions):
+    save_bitmap(tmp_path, "a.tex", "tag")
+    save_bitmap(tmp_path, "b.tex", "tag")
+    images.flush_bitmaps()
+    save_bitmap(tmp_path, "c.tex", "tag")
+    images.flush_bitmaps()
+
+    assert conversions == [("a.tex", "tag.png")]
+
+
+def test_save_bitmap_converts_last_mi_bitmap(tmp_path, conversions):
+    save_bitmap(tmp_path, "a.tex", "tag", "Rare")
+    save_bitmap(tmp_path, "b.tex", "tag", "Rare")
+    images.flush_bitmaps()
+
+    assert conversions == [("b.tex", "tag.png")]
+    assert (tmp_path / "graphics" / "tag.png").read_text() == "b.tex"
+
+
+def test_save_bitmap_skips_unchanged_bitmap(tmp_path, conversions):
+    save_bitmap(tmp_path, "a.tex", "tag", "Rare")
+    os.utime(tmp_path / "a.tex", (0, 0))
+    images.flush_bitmaps()
+    save_bitmap(tmp_path, "a.tex", "tag", "Rare")
+    images.flush_bitmaps()
+
+    assert conversions == [("a.tex", "tag.png")]
+
+
+def test_save_bitmap_retries_failed_conversion(tmp_path, conversions):
+    save_bitmap(tmp_path, "broken.tex", "tag")
+    images.flush_bitmaps()
+    save_bitmap(tmp_path, "a.tex", "tag")
+    images.flush_bitmaps()
+
+    assert conversions == [("broken.tex", "tag.png"), ("a.tex", "tag.png")]
+    assert (tmp_path / "graphics" / "tag.png").read_text() == "a.tex"
+
+
+def test_save_bitmap_fixes_version_2_bitmaps(tmp_path, conversions):
+    (tmp_path / "a.tex").write_bytes(b"TEX\x02abcdXefgh")
+    save_bitmap(tmp_path, "a.tex", "tag")
+    images.flush_bitmaps()
+
+    assert conversions == [("a.fixed.tex", "tag.png")]
+    assert (tmp_path / "a.fixed.tex").read_bytes() == b"TEX\x01abcdefgh"